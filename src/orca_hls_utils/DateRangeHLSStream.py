@@ -1,30 +1,31 @@
 
 from . import s3_utils
-import boto3
-from botocore import UNSIGNED
-from botocore.config import Config
 
-import m3u8
 import math
 from . import scraper
 import ffmpeg
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from datetime import timedelta
-from pytz import timezone
 import time
-import sys
 from pathlib import Path
 from . import datetime_utils
+import logging
+
+logger = logging.getLogger(__name__)
 
 def get_readable_clipname(hydrophone_id, cliptime_utc):
     # cliptime is of the form 2020-09-27T00/16/55.677242Z
-    cliptime_utc = timezone('UTC').localize(cliptime_utc)
-    date = cliptime_utc.astimezone(timezone('US/Pacific'))
+    cliptime_utc = datetime_utils.UTC.localize(cliptime_utc)
+    date = cliptime_utc.astimezone(datetime_utils.PACIFIC)
     date_format='%Y_%m_%d_%H_%M_%S_%Z'
     clipname = date.strftime(date_format)
     return hydrophone_id + "_" + clipname, date
 
+# Background loader for the playlist of the next clip, shared by all streams
+_prefetch_executor = ThreadPoolExecutor(max_workers=2)
+
 #TODO: Handle date ranges that don't exist
 class DateRangeHLSStream():
     """
@@ -34,9 +35,13 @@ class DateRangeHLSStream():
     end_unix_time
     wav_dir
     real_time = if False, get data as soon as possible, if true wait for polling interval before pulling
+    session = optional requests.Session for every HTTP fetch (playlist loads and reloads, segment downloads),
+        so its adapters and auth apply to all of them. Defaults to a shared keep-alive session
+    playlist_cache = optional dict of playlist url -> loaded m3u8 playlist, filled as playlists are loaded and
+        consulted before fetching. Share one between streams over the same historical folders
     """
 
-    def __init__(self, stream_base, polling_interval, start_unix_time, end_unix_time, wav_dir, real_time=False):
+    def __init__(self, stream_base, polling_interval, start_unix_time, end_unix_time, wav_dir, real_time=False, session=None, playlist_cache=None):
         """
 
         """
@@ -48,6 +53,8 @@ class DateRangeHLSStream():
         self.end_unix_time = end_unix_time
         self.wav_dir = wav_dir
         self.real_time = real_time
+        self.session = session
+        self.playlist_cache = playlist_cache
         self.is_end_of_stream = False
 
         # query the stream base for all m3u8 files between the timestamps
@@ -56,22 +63,28 @@ class DateRangeHLSStream():
         # eg. 'https://s3-us-west-2.amazonaws.com/streaming-orcasound-net/rpi_orcasound_lab'
         # would be split into s3_bucket = 'streaming-orcasound-net' and folder_name = 'rpi_orcasound_lab'
 
-        bucket_folder = self.stream_base.split("https://s3-us-west-2.amazonaws.com/")[1]
-        tokens = bucket_folder.split("/")
-        self.s3_bucket = tokens[0]
-        self.folder_name = tokens[1]
+        self.s3_bucket, self.folder_name = s3_utils.parse_stream_base(self.stream_base)
         prefix = self.folder_name + "/hls/"
 
         # returns folder names corresponding to epochs, this grows as more data is added, we should probably maintain a list of 
         # hydrophone folders that exist
         all_hydrophone_folders = s3_utils.get_all_folders(self.s3_bucket, prefix=prefix)
-        print("Found {} folders in all for hydrophone".format(len(all_hydrophone_folders)))
+        logger.info("Found %d folders in all for hydrophone", len(all_hydrophone_folders))
 
         self.valid_folders = s3_utils.get_folders_between_timestamp(all_hydrophone_folders, self.start_unix_time, self.end_unix_time)
-        print("Found {} folders in date range".format(len(self.valid_folders)))
+        logger.info("Found %d folders in date range", len(self.valid_folders))
 
         self.current_folder_index = 0
         self.current_clip_start_time = self.start_unix_time
+        # there is no audio before the first folder, so a range starting earlier begins
+        # with that folder. Otherwise the segment index into its playlist would go negative
+        if self.valid_folders and int(self.start_unix_time) < self.valid_folders[0]:
+            self.current_clip_start_time = self.valid_folders[0]
+
+        # (stream_url, future) for the playlist the next clip is expected to read
+        self._prefetch = None
+        # a clip in the same folder re-reads the same playlist, that reload is a 304
+        self._playlists = scraper.PlaylistVersions(session)
 
     def get_next_clip(self, current_clip_name = None):
         """
@@ -86,11 +99,11 @@ class DateRangeHLSStream():
         if self.real_time:
             # sleep till enough time has elapsed
 
-            now = datetime.utcnow()
+            now = datetime.now(datetime_utils.UTC).replace(tzinfo=None)
             time_to_sleep = (current_clip_name-now).total_seconds()
 
             if time_to_sleep < 0:
-                print("Issue with timing")
+                logger.warning("Issue with timing")
 
             if time_to_sleep > 0:
                 time.sleep(time_to_sleep)
@@ -99,7 +112,7 @@ class DateRangeHLSStream():
         # stream_url for the current AWS folder
         stream_url = "{}/hls/{}/live.m3u8".format(
             (self.stream_base), (current_folder))
-        stream_obj = m3u8.load(stream_url)
+        stream_obj = self._load_playlist(stream_url)
         num_total_segments = len(stream_obj.segments)
         num_segments_in_wav_duration = math.ceil(self.polling_interval_in_seconds/stream_obj.target_duration)
 
@@ -117,37 +130,28 @@ class DateRangeHLSStream():
         # We do this before we actually do the pulling in case there is a problem with this clip
         self.current_clip_start_time = datetime_utils.add_interval_to_unix_time(self.current_clip_start_time, self.polling_interval_in_seconds)
 
-        # Create tmp path to hold .ts segments
-        tmp_path = "tmp_path"
-        os.makedirs(tmp_path,exist_ok=True)
-
-        file_names = []
-        for i in range(segment_start_index, segment_end_index):
-            audio_segment = stream_obj.segments[i]
-            base_path = audio_segment.base_uri
-            file_name = audio_segment.uri
-            audio_url = base_path + file_name
-            try:
-                scraper.download_from_url(audio_url,tmp_path)
-                file_names.append(file_name)
-            except Exception:
-                print("Skipping",audio_url,": error.")
-
-        # concatentate all .ts files with ffmpeg
-        hls_file = (clipname+".ts")
-        audio_file = (clipname+".wav")
-        wav_file_path = os.path.join(self.wav_dir, audio_file)
-        filenames_str = " ".join(file_names)
-        concat_ts_cmd = "cd {tp} && cat {fstr} > {hls_file}".format(tp=tmp_path, fstr=filenames_str, hls_file=hls_file)
-        os.system(concat_ts_cmd)
-        
-        # read the concatenated .ts and write to wav
-        stream = ffmpeg.input(os.path.join(tmp_path, Path(hls_file)))
-        stream = ffmpeg.output(stream, wav_file_path)
-        ffmpeg.run(stream, quiet=False)
-
-        # clear the tmp_path
-        os.system(f'rm -rf {tmp_path}')
+        # Create a fresh scratch dir to hold .ts segments. It lives under the
+        # system temp dir (point TMPDIR at a tmpfs to keep segments off disk)
+        # and is removed even when a download or ffmpeg fails
+        with tempfile.TemporaryDirectory() as tmp_path:
+            segments = stream_obj.segments[segment_start_index:segment_end_index]
+            file_names = scraper.download_segments(segments, tmp_path, session=self.session)
+
+            # concatenate the .ts segments in playlist order, in memory rather than into a .ts file
+            audio_file = (clipname+".wav")
+            wav_file_path = os.path.join(self.wav_dir, audio_file)
+            ts_bytes = b"".join(Path(tmp_path, file_name).read_bytes() for file_name in file_names)
+
+            # the next clip usually reads the same playlist, so fetch it while ffmpeg runs.
+            # Not in real_time mode, where the playlist would go stale while we sleep
+            if not self.real_time and not self.is_stream_over() and not self._is_playlist_cached(stream_url):
+                self._prefetch = (stream_url, _prefetch_executor.submit(
+                    scraper.load_playlist, stream_url, self._playlists.previous(stream_url), session=self.session))
+
+            # pipe the concatenated .ts to ffmpeg on stdin and write to wav
+            stream = ffmpeg.input("pipe:", format="mpegts")
+            stream = ffmpeg.output(stream, wav_file_path)
+            ffmpeg.run(stream, input=ts_bytes, quiet=False)
 
         # If we're in demo mode, we need to fake timestamps to make it seem like the date range is real-time
         if current_clip_name:
@@ -164,6 +168,36 @@ class DateRangeHLSStream():
         # Get new index
         return wav_file_path, clip_start_time, current_clip_name
 
+    def _is_playlist_cached(self, stream_url):
+        return self.playlist_cache is not None and stream_url in self.playlist_cache
+
+    def _load_playlist(self, stream_url):
+        if self._is_playlist_cached(stream_url):
+            return self.playlist_cache[stream_url]
+
+        version = None
+        # use the playlist prefetched during the last clip when it is the one we need
+        if self._prefetch is not None:
+            prefetch_url, future = self._prefetch
+            self._prefetch = None
+            if prefetch_url == stream_url:
+                try:
+                    version = future.result()
+                except (OSError, ValueError):
+                    logger.warning("Prefetch of %s failed, loading it again", stream_url)
+            else:
+                future.cancel()
+        if version is not None:
+            # remembered here, on the caller's thread, the prefetch just returns its (etag, playlist)
+            self._playlists.remember(stream_url, version)
+            stream_obj = version[1]
+        else:
+            stream_obj = self._playlists.load(stream_url)
+
+        if self.playlist_cache is not None:
+            self.playlist_cache[stream_url] = stream_obj
+        return stream_obj
+
     def is_stream_over(self):
         # returns true or false based on whether the stream is over
         return int(self.current_clip_start_time) >= int(self.end_unix_time)
\ No newline at end of file
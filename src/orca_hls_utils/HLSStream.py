@@ -1,65 +1,80 @@
 # HLSStream class 
-import urllib.request
 import os
-import m3u8
+import tempfile
 import math
 import ffmpeg #ffmpeg-python
 from . import scraper
+from . import s3_utils
 from datetime import datetime
 from datetime import timedelta
 
 import time
-from pytz import timezone
 from . import datetime_utils
 from pathlib import Path
 
-import boto3
-from botocore import UNSIGNED
-from botocore.config import Config
+import logging
+
+logger = logging.getLogger(__name__)
 
 def get_readable_clipname(hydrophone_id, cliptime_utc):
     # cliptime is of the form 2020-09-27T00/16/55.677242Z
-    cliptime_utc = timezone('UTC').localize(cliptime_utc)
-    date = cliptime_utc.astimezone(timezone('US/Pacific'))
+    cliptime_utc = datetime_utils.UTC.localize(cliptime_utc)
+    date = cliptime_utc.astimezone(datetime_utils.PACIFIC)
     date_format='%Y_%m_%d_%H_%M_%S_%Z'
     clipname = date.strftime(date_format)
     return hydrophone_id + "_" + clipname, date
 
+# default for how long to keep polling for the last .ts segment of a clip to be uploaded
+SEGMENT_UPLOAD_BUFFER = 10
+
 #TODO (@prgogia) Handle errors due to rebooting of hydrophone
 class HLSStream():
     """
     stream_base = 'https://s3-us-west-2.amazonaws.com/streaming-orcasound-net/rpi_orcasound_lab'
     polling_interval = 60 sec
+    session = optional requests.Session for every HTTP fetch (latest.txt, playlist loads and reloads, segment
+        downloads), so its adapters and auth apply to all of them. Defaults to a shared keep-alive session
+    min_interval, max_interval, rate = backoff used while polling for the clip's last segments,
+        the n-th retry sleeps min(max_interval, min_interval * rate**n)
+    upload_buffer = total seconds to poll for the clip's last segments before giving up on it,
+        the last sleep is cut short so the polling never runs past it
     """
 
-    def __init__(self, stream_base, polling_interval, wav_dir):
+    def __init__(self, stream_base, polling_interval, wav_dir, session=None, min_interval=0.25, max_interval=10, rate=1.5, upload_buffer=SEGMENT_UPLOAD_BUFFER):
         self.stream_base = stream_base
         self.polling_interval = polling_interval
         self.wav_dir = wav_dir
-        bucket_folder = self.stream_base.split("https://s3-us-west-2.amazonaws.com/")[1]
-        tokens = bucket_folder.split("/")
-        self.s3_bucket = tokens[0]
-        self.hydrophone_id = tokens[1]
+        self.session = session
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate = rate
+        self.upload_buffer = upload_buffer
+        self.s3_bucket, self.hydrophone_id = s3_utils.parse_stream_base(self.stream_base)
+
+        # stream ids whose live.m3u8 has been seen, a playlist never goes away once written
+        self._streams_with_playlist = set()
+        # reloads while waiting on a segment mostly find the playlist unchanged, those are a 304
+        self._playlists = scraper.PlaylistVersions(session)
 
     # this function grabs audio from last_end_time to 
     def get_next_clip(self, current_clip_end_time):
 
         # if current time < current_clip_end_time, sleep for the difference
-        now = datetime.utcnow()
+        now = datetime.now(datetime_utils.UTC).replace(tzinfo=None)
 
-        # the extra 10 seconds to sleep is to download the last .ts segment properly
-        time_to_sleep = (current_clip_end_time-now).total_seconds() + 10
+        # we then poll below until the last .ts segment has been uploaded,
+        # rather than always sleeping a fixed extra 10 seconds
+        time_to_sleep = (current_clip_end_time-now).total_seconds()
 
-        if time_to_sleep < 10:
+        if time_to_sleep < 0:
             # This implies that we took more than polling interval seconds to do our processing
             # Ideally, we should set current_clip_end_time = now at this point
             current_clip_end_time = now
-            time.sleep(10)
 
-            print("Fell behind now so fast forwarding current_clip_end_time")
+            logger.warning("Fell behind now so fast forwarding current_clip_end_time")
         else:
-            # In steady state, time_to_sleep is ~41 seconds
-            # the very first time, it's ~20 seconds
+            # In steady state, time_to_sleep is ~31 seconds
+            # the very first time, it's ~10 seconds
             time.sleep(time_to_sleep)
 
         current_clip_start_time = current_clip_end_time - timedelta(0,60)
@@ -67,31 +82,27 @@ class HLSStream():
         clipname, _ = get_readable_clipname(self.hydrophone_id, current_clip_start_time)
 
         # get latest AWS bucket
-        print("Listening to location {loc}".format(loc=self.stream_base))
+        logger.info("Listening to location %s", self.stream_base)
         latest = f"{self.stream_base}/latest.txt"
-        stream_id = urllib.request.urlopen(
-            latest).read().decode("utf-8").replace("\n", "")
+        stream_id = scraper.read_text_from_url(latest, session=self.session).replace("\n", "")
 
         # stream_url for the current AWS bucket
         stream_url = "{}/hls/{}/live.m3u8".format(
             (self.stream_base), (stream_id))
         
-        # check if m3u8 file exists
-        s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-        prefix = "{}/hls/{}/live.m3u8".format(self.hydrophone_id, stream_id)
-        objs = s3.list_objects_v2(Bucket=self.s3_bucket, Prefix=prefix, MaxKeys=1, Delimiter="/")
-        
-        # if it does not, exit
-        if objs["KeyCount"] == 0:
-            print(".m3u8 file does not exist, will retry after some time")
-            return None, None, current_clip_end_time
-        
-        assert objs["KeyCount"] == 1
+        # check if m3u8 file exists, only until we have seen it for this stream id
+        if stream_id not in self._streams_with_playlist:
+            s3 = s3_utils.get_s3_client()
+            prefix = "{}/hls/{}/live.m3u8".format(self.hydrophone_id, stream_id)
+            objs = s3.list_objects_v2(Bucket=self.s3_bucket, Prefix=prefix, MaxKeys=1, Delimiter="/")
 
-        # .m3u8 file exists so load it
-        stream_obj = m3u8.load(stream_url)
-        num_total_segments = len(stream_obj.segments)
-        num_segments_in_wav_duration = math.ceil(self.polling_interval/stream_obj.target_duration)
+            # if it does not, exit
+            if objs["KeyCount"] == 0:
+                logger.warning(".m3u8 file does not exist, will retry after some time")
+                return None, None, current_clip_end_time
+
+            assert objs["KeyCount"] == 1
+            self._streams_with_playlist.add(stream_id)
 
         # calculate the start index by computing the current time - start of current folder
         current_clip_end_time_unix_pst = datetime_utils.get_unix_time_from_datetime_utc(current_clip_end_time)
@@ -101,45 +112,46 @@ class HLSStream():
             # and we do not have enough data for a 1 minute clip + 20 second buffer 
             # we exit and try again after hls polling interval
             None, None, current_clip_end_time
-        
-        min_num_total_segments_required = math.ceil(time_since_folder_start/stream_obj.target_duration)
-        segment_start_index = min_num_total_segments_required - num_segments_in_wav_duration + 1
-        segment_end_index = segment_start_index + num_segments_in_wav_duration
-
-        if segment_end_index > num_total_segments:
-            return None, None, current_clip_end_time
-
-        # Create tmp path to hold .ts segments
-        tmp_path = "tmp_path"
-        os.makedirs(tmp_path,exist_ok=True)
-
-        file_names = []
-        for i in range(segment_start_index, segment_end_index):
-            audio_segment = stream_obj.segments[i]
-            base_path = audio_segment.base_uri
-            file_name = audio_segment.uri
-            audio_url = base_path + file_name
-            try:
-                scraper.download_from_url(audio_url,tmp_path)
-                file_names.append(file_name)
-            except Exception:
-                print("Skipping",audio_url,": error.")
-
-        # concatentate all .ts files with ffmpeg
-        hls_file = (clipname+".ts")
-        audio_file = (clipname+".wav")
-        wav_file_path = os.path.join(self.wav_dir, audio_file)
-        filenames_str = " ".join(file_names)
-        concat_ts_cmd = "cd {tp} && cat {fstr} > {hls_file}".format(tp=tmp_path, fstr=filenames_str, hls_file=hls_file)
-        os.system(concat_ts_cmd)
-        
-        # read the concatenated .ts and write to wav
-        stream = ffmpeg.input(os.path.join(tmp_path, Path(hls_file)))
-        stream = ffmpeg.output(stream, wav_file_path)
-        ffmpeg.run(stream, quiet=True)
 
-        # clear the tmp_path
-        os.system(f'rm -rf {tmp_path}')
+        # .m3u8 file exists so load it, reloading with backoff until the
+        # clip's last segment shows up or upload_buffer runs out
+        waited = 0
+        attempt = 0
+        while True:
+            stream_obj = self._playlists.load(stream_url)
+            num_total_segments = len(stream_obj.segments)
+            num_segments_in_wav_duration = math.ceil(self.polling_interval/stream_obj.target_duration)
+
+            min_num_total_segments_required = math.ceil(time_since_folder_start/stream_obj.target_duration)
+            segment_start_index = min_num_total_segments_required - num_segments_in_wav_duration + 1
+            segment_end_index = segment_start_index + num_segments_in_wav_duration
+
+            if segment_end_index <= num_total_segments:
+                break
+            if waited >= self.upload_buffer:
+                return None, None, current_clip_end_time
+
+            backoff = min(self.max_interval, self.min_interval * self.rate ** attempt, self.upload_buffer - waited)
+            time.sleep(backoff)
+            waited += backoff
+            attempt += 1
+
+        # Create a fresh scratch dir to hold .ts segments. It lives under the
+        # system temp dir (point TMPDIR at a tmpfs to keep segments off disk)
+        # and is removed even when a download or ffmpeg fails
+        with tempfile.TemporaryDirectory() as tmp_path:
+            segments = stream_obj.segments[segment_start_index:segment_end_index]
+            file_names = scraper.download_segments(segments, tmp_path, session=self.session)
+
+            # concatenate the .ts segments in playlist order, in memory rather than into a .ts file
+            audio_file = (clipname+".wav")
+            wav_file_path = os.path.join(self.wav_dir, audio_file)
+            ts_bytes = b"".join(Path(tmp_path, file_name).read_bytes() for file_name in file_names)
+
+            # pipe the concatenated .ts to ffmpeg on stdin and write to wav
+            stream = ffmpeg.input("pipe:", format="mpegts")
+            stream = ffmpeg.output(stream, wav_file_path)
+            ffmpeg.run(stream, input=ts_bytes, quiet=True)
 
         return wav_file_path, clip_start_time, current_clip_end_time
 
@@ -1,21 +1,80 @@
 #! /usr/bin/env python3
-import boto3
-from botocore import UNSIGNED
-from botocore.config import Config
+import bisect
+import functools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# memoized folder listings are refreshed after this many seconds, new folders
+# only show up when a hydrophone restarts its stream
+FOLDER_CACHE_TTL = 300
+
+@functools.lru_cache(maxsize=128)
+def parse_stream_base(stream_base: str) -> (str, str):
+    """
+    Split a stream base into its S3 bucket and hydrophone folder, e.g.
+    'https://s3-us-west-2.amazonaws.com/streaming-orcasound-net/rpi_orcasound_lab'
+    gives ('streaming-orcasound-net', 'rpi_orcasound_lab').
+
+    Streams are often rebuilt for the same stream base, so results are memoized.
+    """
+    bucket_folder = stream_base.split("https://s3-us-west-2.amazonaws.com/")[1]
+    tokens = bucket_folder.split("/")
+    return tokens[0], tokens[1]
 
-# Borrowed pagination code from https://alexwlchan.net/2019/07/listing-s3-keys/
 def get_all_folders(bucket: str, prefix: str) -> [str]:
     """
     Generate objects in an S3 bucket.
 
+    Listings are memoized per (bucket, prefix) for up to FOLDER_CACHE_TTL
+    seconds, so repeatedly opening streams on the same hydrophone only lists
+    S3 once. To see newly added folders before the TTL runs out, call
+    clear_folder_cache(). Empty listings are not memoized, so a hydrophone
+    queried before its first folder exists is listed again on the next call.
+
     :param bucket: Name of the S3 bucket.
     :param prefix: Only fetch objects whose key starts with
         this prefix (optional).
     :param suffix: Only fetch objects whose keys end with
         this suffix (optional).
     """
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    paginator = s3.get_paginator("list_objects_v2")
+    # the ttl bucket is part of the cache key and changes every FOLDER_CACHE_TTL
+    # seconds, so a fresh listing is fetched. Entries under old keys are no longer
+    # looked up and are dropped when the LRU evicts them
+    ttl_bucket = int(time.monotonic() // FOLDER_CACHE_TTL)
+    try:
+        return list(_list_folders(bucket, prefix, ttl_bucket))
+    except _NoFolders:
+        logger.warning("No content returned")
+        return []
+
+def clear_folder_cache():
+    """Forget memoized folder listings so the next call hits S3 again."""
+    _list_folders.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    """
+    Return the anonymous S3 client shared by the whole package.
+
+    It is created on first use and then reused, so its connection pool and
+    keep-alive connections survive across listings and polls.
+    """
+    # boto3 is slow to import, so only pull it in when S3 is first needed
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
+    return boto3.client('s3', config=Config(signature_version=UNSIGNED))
+
+class _NoFolders(Exception):
+    """Raised for an empty listing, lru_cache does not keep results that raise."""
+
+# Borrowed pagination code from https://alexwlchan.net/2019/07/listing-s3-keys/
+@functools.lru_cache(maxsize=16)
+def _list_folders(bucket, prefix, ttl_bucket):
+    paginator = get_s3_client().get_paginator("list_objects_v2")
 
     kwargs = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': "/"}
 
@@ -30,17 +89,23 @@ def get_all_folders(bucket: str, prefix: str) -> [str]:
             all_keys.extend(prefixes)
 
         except KeyError:
-            print("No content returned")
             break
 
-    return all_keys
+    if not all_keys:
+        raise _NoFolders(prefix)
+    return tuple(all_keys)
 
 def get_folders_between_timestamp(bucket_list: [str], start_time: str, end_time: str) -> [int]:
-    bucket_list = [int(bucket) for bucket in bucket_list]
-    start_index = 0
-    end_index = len(bucket_list) - 1
-    while int(bucket_list[start_index]) < int(start_time):
-        start_index += 1
-    while int(bucket_list[end_index]) > int(end_time):
-        end_index -= 1
-    return bucket_list[start_index-1:end_index + 1]
\ No newline at end of file
+    """
+    Return the folders covering start_time..end_time, including the folder
+    that was already recording at start_time.
+
+    Folder names are unix timestamps, so the boundaries are found by binary
+    search. Raises IndexError when no folder starts at or after start_time.
+    """
+    bucket_list = sorted(int(bucket) for bucket in bucket_list)
+    start_index = bisect.bisect_left(bucket_list, int(start_time))
+    if start_index == len(bucket_list):
+        raise IndexError("no folders at or after {}".format(start_time))
+    end_index = bisect.bisect_right(bucket_list, int(end_time))
+    return bucket_list[max(start_index - 1, 0):end_index]
\ No newline at end of file
@@ -1,9 +1,21 @@
 import os, sys, json, glob
-import requests, bs4, urllib
+import requests, bs4
 import tqdm
-import pandas as pd
+import m3u8
 from os.path import dirname
 from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Segments are fetched from a thread pool through one shared session, so
+# repeated downloads reuse keep-alive connections instead of a new TLS
+# handshake per file. The connection pool is sized to the worker count.
+DOWNLOAD_WORKERS = 8
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS))
 
 class TqdmUpTo(tqdm.tqdm):
     """Provides `update_to(n)` which uses `tqdm.update(delta_n)`."""
@@ -58,7 +70,7 @@ def parse_database_page_to_tsv(url,tsvfile):
                     contents[5].a['href'].split('(')[1].split(')')[0].replace('\'','')
                 ])
             f.write('\t'.join([name,loc,date,audio,metadata])+'\n')
-    print("Parsed links for",len(rows),"rows to file:",tsvfile)
+    logger.info("Parsed links for %d rows to file: %s", len(rows), tsvfile)
 
 def select_and_get_urls(main_url,common_name): # for fun could be done recursively
     main_soup = _geturlsoup(main_url)
@@ -107,20 +119,107 @@ def fetch_all_metadata(save_dir,whale):
     with open(os.path.join(save_dir,whale,"metadata.json"),'w') as f:
         json.dump(metadata_json,f)
 
-def download_from_url(dl_url,dl_dir):
-    # download only if not already exists
+def read_text_from_url(url,session=None):
+    # small text fetches (e.g. latest.txt) share the keep-alive session with segment downloads
+    response = (session or _session).get(url)
+    response.raise_for_status()
+    return response.content.decode("utf-8")
+
+def load_playlist(url,previous=None,session=None):
+    """
+    Load an m3u8 playlist with a conditional GET.
+
+    previous is the (etag, playlist) pair returned by an earlier call for the
+    same url. Its ETag is sent as If-None-Match, and when the server answers
+    304 Not Modified the earlier playlist is returned without transferring
+    or re-parsing the body.
+
+    Returns a new (etag, playlist) pair; etag is None if the server sent none.
+    """
+    etag, playlist = previous or (None, None)
+    headers = {"If-None-Match": etag} if etag else {}
+    response = (session or _session).get(url, headers=headers)
+    if response.status_code == 304 and playlist is not None:
+        return etag, playlist
+    response.raise_for_status()
+    # base_uri as m3u8.load sets it, so segment urls stay base_uri + uri
+    playlist = m3u8.M3U8(response.content.decode("utf-8"), base_uri=urljoin(response.url, "."))
+    return response.headers.get("ETag"), playlist
+
+class PlaylistVersions:
+    """
+    Remembers the last (etag, playlist) returned by load_playlist, so that
+    reloading the same url sends its ETag and an unchanged playlist is a 304.
+    """
+    def __init__(self, session=None):
+        self.session = session
+        self._last = (None, None, None)
+
+    def previous(self, url):
+        """The (etag, playlist) to pass to load_playlist for url, None if url was not the last one loaded."""
+        last_url, etag, playlist = self._last
+        return (etag, playlist) if last_url == url else None
+
+    def remember(self, url, version):
+        """Record the (etag, playlist) pair load_playlist returned for url."""
+        etag, playlist = version
+        self._last = (url, etag, playlist)
+
+    def load(self, url):
+        """Load url, conditionally if it was the last one loaded, and return the playlist."""
+        version = load_playlist(url, self.previous(url), session=self.session)
+        self.remember(url, version)
+        return version[1]
+
+def download_from_url(dl_url,dl_dir,session=None):
+    # download only if not already exists, over the shared session unless one is given
     file_name = os.path.basename(dl_url)
     dl_path = os.path.join(dl_dir,file_name)
     if os.path.isfile(dl_path):
-        print("Skipping",file_name,"as it already exists.")
+        logger.debug("Skipping %s as it already exists.", file_name)
     else:
-        print("Downloading",file_name)
+        logger.debug("Downloading %s", file_name)
+        # write to a .part file and move it into place once complete, so an
+        # interrupted download never sits under the real name and gets skipped later
+        part_path = dl_path + ".part"
         with TqdmUpTo(unit='B', unit_scale=True, miniters=1,
                     desc=dl_url.split('/')[-1]) as t:  # all optional kwargs
-            urllib.request.urlretrieve(dl_url, filename=dl_path,
-                            reporthook=t.update_to)
+            with (session or _session).get(dl_url, stream=True) as response:
+                response.raise_for_status()
+                tsize = int(response.headers.get('content-length', 0)) or None
+                with open(part_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+                        t.update_to(bsize=f.tell(), tsize=tsize)
+        os.replace(part_path, dl_path)
+
+def download_segments(segments,dl_dir,max_workers=DOWNLOAD_WORKERS,session=None):
+    """
+    Download HLS segments into dl_dir concurrently, keeping playlist order.
+
+    Segment fetches are latency bound, so they are issued from a small thread
+    pool rather than one after another. Pass a requests.Session to reuse its
+    connection pool instead of the module-wide one.
+
+    Returns the file names of the segments that were fetched; segments that
+    fail to download are skipped.
+    """
+    urls = [audio_segment.base_uri + audio_segment.uri for audio_segment in segments]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download_from_url,audio_url,dl_dir,session) for audio_url in urls]
+
+    file_names = []
+    for audio_segment, audio_url, future in zip(segments, urls, futures):
+        try:
+            future.result()
+            file_names.append(audio_segment.uri)
+        except OSError:
+            logger.warning("Skipping %s: error.", audio_url)
+    return file_names
 
 def download_all_cuts(save_dir,whale,wav_dir):
+    import pandas as pd # heavy import, only needed here
+
     cuts_tsv = os.path.join(save_dir,whale,"allcuts.tsv")
     wav_dir = os.path.join("./data/wavcut",whale)
 